@@ -1,14 +1,16 @@
 # main.py
-from datetime import date, time
+from datetime import date, time, timezone
 from typing import List, Optional
-import os, logging
+import os, logging, asyncio
 import datetime as dt
 import httpx
+import orjson
 
 from fastapi import FastAPI, HTTPException, Query, Header
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel, field_validator, Field
-import databases
+import asyncpg
 import secrets
 import re
 
@@ -17,10 +19,31 @@ DATABASE_URL = os.getenv("DATABASE_URL")
 if not DATABASE_URL:
     raise RuntimeError("DATABASE_URL が未設定です（本番環境の環境変数に設定してください）")
 
-database = databases.Database(DATABASE_URL)
+def _log_pg_message(con, message):
+    # サーバーからの NOTICE / WARNING（移行処理の RAISE WARNING など）をアプリのログへ流す
+    severity = getattr(message, "severity_en", None) or message.severity
+    level = logging.WARNING if severity in ("WARNING", "ERROR", "FATAL", "PANIC") else logging.INFO
+    logging.log(level, "postgres %s: %s", severity, message.message)
+
+async def _setup_connection(con):
+    # asyncpg はリスナーが無いとサーバーのメッセージを捨て、返却時の reset でリスナーも外すため取得のたびに登録する
+    con.add_log_listener(_log_pg_message)
+
+async def _init_connection(con):
+    # 接続ごとの初期化（プール生成時に min_size 本ぶん実行され、接続が開通済みになる）
+    # json 列は Python の list/dict にデコードして受け取る
+    await con.set_type_codec(
+        "json", encoder=lambda v: orjson.dumps(v).decode(), decoder=orjson.loads, schema="pg_catalog"
+    )
+
+# 起動時に生成（startup 参照）
+pool: asyncpg.Pool | None = None
+DB_CONNECT_RETRIES = 5
 
 # ========= FastAPI =========
-app = FastAPI()
+# レスポンスは orjson で直列化（date/datetime もそのまま渡してよい）。DB 由来の参照系は
+# ORJSONResponse をそのまま返し、jsonable_encoder による再走査を省く（入力モデルの検証はそのまま）
+app = FastAPI(default_response_class=ORJSONResponse)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  # 本番はフロントのドメインに絞ってください
@@ -45,7 +68,7 @@ class BreakIn(BaseModel):
 class ShiftIn(BaseModel):
     employee_id: int
     work_date: date          # "YYYY-MM-DD"
-    year: int                # テーブル名生成用（ゼロ詰めなし）
+    year: int                # 互換のため残置（格納先パーティションは work_date で決まる）
     month: int
     day: int
     start_work: Optional[time] = None
@@ -68,27 +91,27 @@ class LiffBindIn(BaseModel):
     code: str
 
 # ========= Helpers / DDL =========
-def table_names_for(year: int, month: int) -> tuple[str, str]:
-    # 例: "work_2025_9", "break_2025_9"（ダブルクォートで識別子を保護）
-    work = f'"work_{year}_{month}"'
-    brk  = f'"break_{year}_{month}"'
-    return work, brk
+# 勤務/休憩は work_date で月ごとにレンジパーティション化した 1 テーブルずつ。
+# SQL は全月共通の固定文字列になるので、asyncpg の prepared statement がそのまま使い回される
+WORK_TBL = '"work"'
+BREAK_TBL = '"break"'
 
-async def ensure_month_tables(year: int, month: int):
-    """指定の年/月テーブルが無ければ作成します。"""
-    WORK_TBL, BREAK_TBL = table_names_for(year, month)
+async def ensure_shift_tables():
+    """パーティション親テーブル / 月パーティション作成関数を用意し、旧方式の月別テーブルを取り込みます。"""
+    await pool.execute(f"""
+    -- 複数ワーカーの同時起動に備えてこのバッチ（暗黙の 1 トランザクション）を直列化する
+    SELECT pg_advisory_xact_lock(hashtext('ensure_shift_tables'));
 
-    create_work_sql = f"""
     CREATE TABLE IF NOT EXISTS {WORK_TBL} (
         id         BIGINT NOT NULL,
         work_date  DATE   NOT NULL,
         start_work TIME,
         end_work   TIME,
         PRIMARY KEY (id, work_date)
-    );
-    """
+    ) PARTITION BY RANGE (work_date);
+    -- 日単位の参照（work_date = ?）用。PK は id 先頭なので別途インデックスを張る
+    CREATE INDEX IF NOT EXISTS "work_wd" ON {WORK_TBL} (work_date);
 
-    create_break_sql = f"""
     CREATE TABLE IF NOT EXISTS {BREAK_TBL} (
         id          BIGINT   NOT NULL,
         work_date   DATE     NOT NULL,
@@ -96,15 +119,235 @@ async def ensure_month_tables(year: int, month: int):
         start_break TIME     NOT NULL,
         end_break   TIME     NOT NULL,
         PRIMARY KEY (id, work_date, seq)
+    ) PARTITION BY RANGE (work_date);
+    CREATE INDEX IF NOT EXISTS "break_wd" ON {BREAK_TBL} (work_date, id, seq);
+
+    -- 旧方式の月別テーブルに紛れていた「その月以外の work_date」の行の退避先（src = 元テーブル名）。
+    -- 旧方式は year/month で指定されたテーブルに保存しており、work_date の月と一致する保証がなかった
+    CREATE TABLE IF NOT EXISTS "work_misfiled" (
+        id         BIGINT NOT NULL,
+        work_date  DATE   NOT NULL,
+        start_work TIME,
+        end_work   TIME,
+        src        TEXT   NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS "break_misfiled" (
+        id          BIGINT   NOT NULL,
+        work_date   DATE     NOT NULL,
+        seq         SMALLINT NOT NULL,
+        start_break TIME     NOT NULL,
+        end_break   TIME     NOT NULL,
+        src         TEXT     NOT NULL
     );
-    """
 
-    async with database.transaction():
-        await database.execute(create_work_sql)
-        await database.execute(create_break_sql)
+    -- 月パーティション "work_Y_M" / "break_Y_M" を用意する。
+    -- 旧方式（月別の独立テーブル、同名）が残っていれば、月外の行を退避してからパーティションとして取り込む。
+    -- 退避済みの行のうちこの月のものはここでシフト単位にパーティションへ移す（競合する写しは退避先に残して警告）
+    CREATE OR REPLACE FUNCTION ensure_shift_partitions(y int, m int) RETURNS void
+    LANGUAGE plpgsql AS $fn$
+    DECLARE
+      lo       date := make_date(y, m, 1);
+      hi       date := (make_date(y, m, 1) + interval '1 month')::date;
+      parent   text;
+      part     text;
+      misfiled text;
+      cols     text;
+      n        bigint;
+    BEGIN
+      -- 初回 POST が複数ワーカーで重なっても同じ月を二重に作らないよう、存在確認の前に月単位で直列化する
+      -- （CREATE TABLE IF NOT EXISTS ... PARTITION OF は同時実行では安全でない）
+      PERFORM pg_advisory_xact_lock(hashtext('ensure_shift_partitions'), y * 100 + m);
+      FOREACH parent IN ARRAY ARRAY['work', 'break'] LOOP
+        part     := format('%s_%s_%s', parent, y, m);
+        misfiled := parent || '_misfiled';
+        IF parent = 'work' THEN
+          cols := 'id, work_date, start_work, end_work';
+        ELSE
+          cols := 'id, work_date, seq, start_break, end_break';
+        END IF;
+
+        IF to_regclass(quote_ident(part)) IS NULL THEN
+          EXECUTE format('CREATE TABLE IF NOT EXISTS %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)',
+                         part, parent, lo, hi);
+        ELSIF NOT (SELECT relispartition FROM pg_class WHERE oid = to_regclass(quote_ident(part))) THEN
+          EXECUTE format('WITH moved AS (DELETE FROM %1$I WHERE work_date < %2$L OR work_date >= %3$L RETURNING %4$s)
+                          INSERT INTO %5$I (%4$s, src) SELECT %4$s, %1$L FROM moved',
+                         part, lo, hi, cols, misfiled);
+          GET DIAGNOSTICS n = ROW_COUNT;
+          IF n > 0 THEN
+            RAISE WARNING '% rows outside %-% moved from % to %', n, y, m, part, misfiled;
+          END IF;
+          EXECUTE format('ALTER TABLE %I ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                         parent, part, lo, hi);
+        END IF;
+      END LOOP;
+
+      -- 退避行は (id, work_date) = 1 日分のシフト単位で移す。パーティション側に勤務も休憩も無い日について
+      -- 元テーブル 1 つ（src の年月部分が最小のもの）を選び、その勤務行と休憩を丸ごと移す。
+      -- 他の元テーブルの写しや、パーティション側に既にある日の写しは退避先に残す（別々の写しを混ぜない）
+      WITH cand AS (
+        SELECT t.id, t.work_date, min(t.srckey) AS srckey
+        FROM (
+          SELECT id, work_date, regexp_replace(src, '^(work|break)_', '') AS srckey
+          FROM "work_misfiled" WHERE work_date >= lo AND work_date < hi
+          UNION ALL
+          SELECT id, work_date, regexp_replace(src, '^(work|break)_', '')
+          FROM "break_misfiled" WHERE work_date >= lo AND work_date < hi
+        ) t
+        WHERE NOT EXISTS (SELECT 1 FROM "work" w
+                          WHERE w.work_date >= lo AND w.work_date < hi
+                            AND w.id = t.id AND w.work_date = t.work_date)
+          AND NOT EXISTS (SELECT 1 FROM "break" b
+                          WHERE b.work_date >= lo AND b.work_date < hi
+                            AND b.id = t.id AND b.work_date = t.work_date)
+        GROUP BY t.id, t.work_date
+      ), mw AS (
+        DELETE FROM "work_misfiled" x USING cand c
+        WHERE x.id = c.id AND x.work_date = c.work_date
+          AND regexp_replace(x.src, '^(work|break)_', '') = c.srckey
+        RETURNING x.id, x.work_date, x.start_work, x.end_work
+      ), mb AS (
+        DELETE FROM "break_misfiled" x USING cand c
+        WHERE x.id = c.id AND x.work_date = c.work_date
+          AND regexp_replace(x.src, '^(work|break)_', '') = c.srckey
+        RETURNING x.id, x.work_date, x.seq, x.start_break, x.end_break
+      ), iw AS (
+        INSERT INTO "work" (id, work_date, start_work, end_work)
+        SELECT id, work_date, start_work, end_work FROM mw
+      )
+      INSERT INTO "break" (id, work_date, seq, start_break, end_break)
+      SELECT id, work_date, seq, start_break, end_break FROM mb;
+
+      SELECT (SELECT count(*) FROM "work_misfiled" WHERE work_date >= lo AND work_date < hi)
+           + (SELECT count(*) FROM "break_misfiled" WHERE work_date >= lo AND work_date < hi)
+        INTO n;
+      IF n > 0 THEN
+        RAISE WARNING '% rows for %-% left in work_misfiled/break_misfiled (conflicting copies; resolve manually)', n, y, m;
+      END IF;
+    END
+    $fn$;
+
+    -- 起動時に旧方式の月別テーブルをまとめて取り込み、退避した行も該当月へ移す。
+    -- 取り込みに失敗した場合は起動ごと失敗させる（書き込めない月を残さない）
+    DO $$
+    DECLARE
+      r record;
+      n bigint;
+    BEGIN
+      FOR r IN
+        SELECT relname, parent, y, m,
+               (y BETWEEN 1 AND 9999 AND m BETWEEN 1 AND 12) AS valid
+        FROM (
+          SELECT relname,
+                 substring(relname from '^(work|break)_') AS parent,
+                 substring(relname from '_([0-9]+)_[0-9]+$')::numeric AS y,
+                 substring(relname from '_([0-9]+)$')::numeric AS m
+          FROM pg_class
+          WHERE relkind = 'r' AND NOT relispartition
+            AND relnamespace = current_schema()::regnamespace
+            AND relname ~ '^(work|break)_[0-9]+_[0-9]+$'
+        ) t
+      LOOP
+        IF r.valid THEN
+          PERFORM ensure_shift_partitions(r.y::int, r.m::int);
+        ELSE
+          -- year/month 未検証時代の "work_2025_13" 等は月パーティションにできないので、
+          -- 全行を退避先へ移す（下のループで work_date の月へ移る）。空になったテーブルは残す
+          IF r.parent = 'work' THEN
+            EXECUTE format('WITH moved AS (DELETE FROM %1$I RETURNING id, work_date, start_work, end_work)
+                            INSERT INTO "work_misfiled" (id, work_date, start_work, end_work, src)
+                            SELECT id, work_date, start_work, end_work, %1$L FROM moved', r.relname);
+          ELSE
+            EXECUTE format('WITH moved AS (DELETE FROM %1$I RETURNING id, work_date, seq, start_break, end_break)
+                            INSERT INTO "break_misfiled" (id, work_date, seq, start_break, end_break, src)
+                            SELECT id, work_date, seq, start_break, end_break, %1$L FROM moved', r.relname);
+          END IF;
+          GET DIAGNOSTICS n = ROW_COUNT;
+          IF n > 0 THEN
+            RAISE WARNING '% rows moved from % (invalid month in table name) to %_misfiled', n, r.relname, r.parent;
+          END IF;
+        END IF;
+      END LOOP;
+
+      FOR r IN
+        SELECT DISTINCT extract(year FROM work_date)::int AS y, extract(month FROM work_date)::int AS m
+        FROM (SELECT work_date FROM "work_misfiled" UNION SELECT work_date FROM "break_misfiled") t
+      LOOP
+        PERFORM ensure_shift_partitions(r.y, r.m);
+      END LOOP;
+    END $$;
+    """)
+
+def month_range(year: int, month: int) -> tuple[date, date]:
+    """指定の年/月の [月初, 翌月初)。"""
+    return date(year, month, 1), date(year + month // 12, month % 12 + 1, 1)
+
+# 1 ステートメント（= 1 往復・単体でアトミック）で 削除 → 再挿入 を行う
+#   del_b/del_w : 休憩/勤務 全削除
+#   ins_w       : 勤務 再挿入（開始/終了が両方ある場合のみ）
+#   本体         : 休憩 再挿入（seq: 1..n は WITH ORDINALITY で採番）
+# CTE の実行順は不定なので、挿入側から削除 CTE を参照して先に削除を完了させる
+# 休憩は配列のバイナリ転送 + unnest で一括挿入する。COPY (copy_records_to_table) は
+# 削除と別の往復 & 明示トランザクションが必要になり、かえって往復が増えるため使わない
+SQL_REPLACE_DAY = f"""
+WITH del_b AS (
+    DELETE FROM {BREAK_TBL} WHERE id = $1::bigint AND work_date = $2::date RETURNING 1
+), del_w AS (
+    DELETE FROM {WORK_TBL} WHERE id = $1 AND work_date = $2 RETURNING 1
+), ins_w AS (
+    INSERT INTO {WORK_TBL} (id, work_date, start_work, end_work)
+    SELECT $1, $2, $3::time, $4::time
+    WHERE $3::time IS NOT NULL AND $4::time IS NOT NULL
+      AND (SELECT count(*) FROM del_w) >= 0
+)
+INSERT INTO {BREAK_TBL} (id, work_date, seq, start_break, end_break)
+SELECT $1, $2, b.seq, b.sb, b.eb
+FROM unnest($5::time[], $6::time[]) WITH ORDINALITY AS b(sb, eb, seq)
+WHERE (SELECT count(*) FROM del_b) >= 0
+"""
+
+# 勤務 + 休憩 を 1 クエリで取得（休憩は seq 順の JSON 配列として集約）
+SQL_SELECT_DAY = f"""
+SELECT w.id,
+       to_char(w.start_work, 'HH24:MI:SS') AS start_work,
+       to_char(w.end_work,   'HH24:MI:SS') AS end_work,
+       COALESCE(
+           json_agg(json_build_object(
+               'start_break', to_char(b.start_break, 'HH24:MI:SS'),
+               'end_break',   to_char(b.end_break,   'HH24:MI:SS')
+           ) ORDER BY b.seq) FILTER (WHERE b.seq IS NOT NULL),
+           '[]'
+       ) AS breaks
+FROM {WORK_TBL} w
+LEFT JOIN {BREAK_TBL} b USING (id, work_date)
+WHERE w.work_date = $1
+GROUP BY w.id, w.work_date
+ORDER BY w.id
+"""
+
+# 月次は行数が多いので date/time のまま返し、orjson に直列化させる。
+# orjson は端数秒があると "HH:MM:SS.ffffff" を出すため、秒で切り捨てて "HH:MM:SS" に揃える
+SQL_SELECT_MONTH = f"""
+SELECT work_date,
+       date_trunc('second', start_work)::time AS start_work,
+       date_trunc('second', end_work)::time   AS end_work
+FROM {WORK_TBL}
+WHERE id = $1 AND work_date >= $2 AND work_date < $3
+ORDER BY work_date
+"""
+
+# このプロセスで作成済みの (year, month)。2 回目以降の書き込みでは DDL を発行しない
+_ensured_months: set[tuple[int, int]] = set()
+
+async def ensure_month_tables(year: int, month: int):
+    """指定の年/月パーティションが無ければ作成します。"""
+    if (year, month) in _ensured_months:
+        return
+    await pool.execute("SELECT ensure_shift_partitions($1, $2)", year, month)
+    _ensured_months.add((year, month))
 
 async def ensure_binding_table():
-    await database.execute("""
+    await pool.execute("""
     CREATE TABLE IF NOT EXISTS line_binding (
       employee_id  BIGINT PRIMARY KEY,
       line_user_id TEXT UNIQUE NOT NULL,
@@ -116,224 +359,204 @@ async def ensure_binding_table():
     """)
 
 async def ensure_onboarding_table():
-    await database.execute("""
+    await pool.execute("""
     CREATE TABLE IF NOT EXISTS onboarding_code (
       employee_id BIGINT NOT NULL,
       code        TEXT   NOT NULL,
-      expires_at  TIMESTAMP NOT NULL,
+      expires_at  TIMESTAMPTZ NOT NULL,
       used_at     TIMESTAMP NULL,
       PRIMARY KEY (employee_id, code)
     );
     """)
+    await _ensure_timestamptz("onboarding_code", "expires_at")
 
 async def ensure_oauth_table():
-    await database.execute("""
+    await pool.execute("""
     CREATE TABLE IF NOT EXISTS oauth_token (
       provider      TEXT PRIMARY KEY,         -- 'freee'
       access_token  TEXT NOT NULL,
       refresh_token TEXT NOT NULL,
-      expires_at    TIMESTAMP NOT NULL,       -- UTC
+      expires_at    TIMESTAMPTZ NOT NULL,
       token_type    TEXT,
       scope         TEXT,
       updated_at    TIMESTAMP NOT NULL DEFAULT NOW()
     );
     """)
-
-# ========= DB lazy connect =========
-async def ensure_db_ready():
-    """必要なときだけ DB 接続 & 初回 DDL 実行。未準備なら 503 を返す。"""
-    if not database.is_connected:
-        try:
-            await database.connect()
-        except Exception as e:
-            logging.exception("DB not ready: %s", e)
-            raise HTTPException(status_code=503, detail="Database not ready")
-    if not getattr(app.state, "ddl_done", False):
-        await ensure_binding_table()
-        await ensure_onboarding_table()
-        await ensure_oauth_table()
-        app.state.ddl_done = True
+    await _ensure_timestamptz("oauth_token", "expires_at")
+
+async def _ensure_timestamptz(table: str, column: str):
+    """旧スキーマの TIMESTAMP 列（UTC の naive 値）を TIMESTAMPTZ に移行します（移行済みなら何もしない）。"""
+    # 複数ワーカーが同時に判定 → ALTER すると、移行済みの列に AT TIME ZONE 'UTC' を二重適用してしまう。
+    # 判定より前にロックを取り、判定と ALTER を同じトランザクション内で直列化する
+    await pool.execute(f"""
+    DO $$
+    BEGIN
+      PERFORM pg_advisory_xact_lock(hashtext('_ensure_timestamptz'));
+      IF EXISTS (
+        SELECT 1 FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = '{table}' AND column_name = '{column}'
+          AND data_type = 'timestamp without time zone'
+      ) THEN
+        ALTER TABLE {table} ALTER COLUMN {column} TYPE TIMESTAMPTZ USING {column} AT TIME ZONE 'UTC';
+      END IF;
+    END $$;
+    """)
 
 # ========= Lifecycle =========
 @app.on_event("startup")
 async def startup():
-    # 起動時は DB に繋がない（PaaS の起動順依存を避ける）
-    pass
+    """起動時に DB 接続 & 共通 DDL を一度だけ実行（PaaS の起動順依存はリトライで吸収）。"""
+    global pool
+    delay = 1.0
+    for attempt in range(1, DB_CONNECT_RETRIES + 1):
+        try:
+            pool = await asyncpg.create_pool(
+                DATABASE_URL,
+                min_size=10,
+                max_size=50,
+                max_queries=50000,
+                max_inactive_connection_lifetime=300,
+                # SQL は全月共通なので、接続ごとの prepared statement を時間経過で破棄せず使い回す
+                max_cached_statement_lifetime=0,
+                init=_init_connection,
+                setup=_setup_connection,
+            )
+            break
+        except Exception as e:
+            if attempt == DB_CONNECT_RETRIES:
+                logging.exception("DB not ready: %s", e)
+                raise
+            logging.warning("DB not ready (attempt %d/%d): %s", attempt, DB_CONNECT_RETRIES, e)
+            await asyncio.sleep(delay)
+            delay *= 2
+    await ensure_shift_tables()
+    await ensure_binding_table()
+    await ensure_onboarding_table()
+    await ensure_oauth_table()
+    # 外部 API（freee / Twilio / SendGrid）向けクライアントは使い回して TLS 接続を再利用する
+    app.state.http = httpx.AsyncClient(timeout=15, limits=httpx.Limits(max_keepalive_connections=10))
 
 @app.on_event("shutdown")
 async def shutdown():
-    if database.is_connected:
-        await database.disconnect()
+    if getattr(app.state, "http", None) is not None:
+        await app.state.http.aclose()
+    if pool is not None:
+        await pool.close()
 
 # ========= Shifts APIs =========
 @app.post("/postShifts")
 async def post_shift(p: ShiftIn):
-    await ensure_db_ready()
-
-    WORK_TBL, BREAK_TBL = table_names_for(p.year, p.month)
     try:
-        await ensure_month_tables(p.year, p.month)
-
-        async with database.transaction():
-            # 1) 休憩 全削除
-            await database.execute(
-                f"DELETE FROM {BREAK_TBL} WHERE id = :id AND work_date = :wd",
-                {"id": p.employee_id, "wd": p.work_date},
-            )
-            # 2) 勤務 全削除
-            await database.execute(
-                f"DELETE FROM {WORK_TBL} WHERE id = :id AND work_date = :wd",
-                {"id": p.employee_id, "wd": p.work_date},
-            )
-            # 3) 勤務 再挿入（開始/終了が両方ある場合のみ）
-            if p.start_work and p.end_work:
-                await database.execute(
-                    f"INSERT INTO {WORK_TBL} (id, work_date, start_work, end_work) VALUES (:id, :wd, :sw, :ew)",
-                    {"id": p.employee_id, "wd": p.work_date, "sw": p.start_work, "ew": p.end_work},
-                )
-            # 4) 休憩 再挿入（seq: 1..n）
-            if p.breaks:
-                insert_break = f"""
-                    INSERT INTO {BREAK_TBL} (id, work_date, seq, start_break, end_break)
-                    VALUES (:id, :wd, :seq, :sb, :eb)
-                """
-                values = [
-                    {"id": p.employee_id, "wd": p.work_date, "seq": i, "sb": br.start_break, "eb": br.end_break}
-                    for i, br in enumerate(p.breaks, start=1)
-                ]
-                await database.execute_many(insert_break, values)
-
+        await ensure_month_tables(p.work_date.year, p.work_date.month)
+        await pool.execute(
+            SQL_REPLACE_DAY,
+            p.employee_id, p.work_date, p.start_work, p.end_work,
+            [br.start_break for br in p.breaks],
+            [br.end_break for br in p.breaks],
+        )
         return {"ok": True}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.get("/getDetailShifts")
-async def get_shifts(year: int = Query(...), month: int = Query(...), day: int = Query(...)):
-    await ensure_db_ready()
-    await ensure_month_tables(year, month)
-
-    work_tbl, break_tbl = table_names_for(year, month)
-    wd = date(year, month, day)
-
-    work_rows = await database.fetch_all(
-        f"SELECT id, start_work, end_work FROM {work_tbl} WHERE work_date = :wd",
-        {"wd": wd},
-    )
-    break_rows = await database.fetch_all(
-        f"SELECT id, start_break, end_break, seq FROM {break_tbl} WHERE work_date = :wd ORDER BY id, seq",
-        {"wd": wd},
-    )
-
-    breaks_by_id = {}
-    for r in break_rows:
-        breaks_by_id.setdefault(r["id"], []).append({
-            "start_break": r["start_break"].strftime("%H:%M:%S"),
-            "end_break":   r["end_break"].strftime("%H:%M:%S"),
-        })
-
-    result = []
-    for w in work_rows:
-        result.append({
-            "employee_id": w["id"],
-            "start_work":  w["start_work"].strftime("%H:%M:%S") if w["start_work"] else None,
-            "end_work":    w["end_work"].strftime("%H:%M:%S") if w["end_work"] else None,
-            "breaks":      breaks_by_id.get(w["id"], []),
-        })
-    return result
-
-@app.get("/getWorkMonth")
-async def get_work_month(id: int = Query(..., alias="id"), year: int = Query(...), month: int = Query(...)):
-    await ensure_db_ready()
-    await ensure_month_tables(year, month)
-
-    work_tbl, _ = table_names_for(year, month)
-    rows = await database.fetch_all(
-        f"""
-        SELECT work_date, start_work, end_work
-        FROM {work_tbl}
-        WHERE id = :id
-        ORDER BY work_date
-        """,
-        {"id": id},
-    )
-    return [
+@app.get("/getDetailShifts", response_model=None)
+async def get_shifts(
+    year: int = Query(..., ge=1, le=9999),
+    month: int = Query(..., ge=1, le=12),
+    day: int = Query(..., ge=1, le=31),
+):
+    try:
+        wd = date(year, month, day)
+    except ValueError:
+        # 2/30 などの存在しない日付
+        raise HTTPException(422, "invalid date")
+
+    # パーティション未作成の月は 0 件になる（参照系ではパーティションを作らない）
+    rows = await pool.fetch(SQL_SELECT_DAY, wd)
+    return ORJSONResponse([
         {
-            "work_date": r["work_date"].isoformat(),
-            "start_work": r["start_work"].strftime("%H:%M:%S") if r["start_work"] else None,
-            "end_work": r["end_work"].strftime("%H:%M:%S") if r["end_work"] else None,
+            "employee_id": w["id"],
+            "start_work":  w["start_work"],
+            "end_work":    w["end_work"],
+            "breaks":      w["breaks"],
         }
-        for r in rows
-    ]
+        for w in rows
+    ])
+
+@app.get("/getWorkMonth", response_model=None)
+async def get_work_month(
+    id: int = Query(..., alias="id"),
+    # 月末の翌日（month_range の上端）が date で表せる範囲に収める
+    year: int = Query(..., ge=1, le=9998),
+    month: int = Query(..., ge=1, le=12),
+):
+    rows = await pool.fetch(SQL_SELECT_MONTH, id, *month_range(year, month))
+    return ORJSONResponse([dict(r) for r in rows])
 
 # ========= Onboarding / Binding =========
 @app.post("/onboarding/code")
 async def issue_code(payload: dict):
-    await ensure_db_ready()
     """管理用: 6桁コード発行（有効10分）"""
     employee_id = int(payload.get("employee_id"))
     code = f"{secrets.randbelow(1_000_000):06d}"
-    expires = dt.datetime.utcnow() + dt.timedelta(minutes=10)
-    await database.execute(
-        "INSERT INTO onboarding_code (employee_id, code, expires_at) VALUES (:e,:c,:x)",
-        {"e": employee_id, "c": code, "x": expires},
+    expires = dt.datetime.now(timezone.utc) + dt.timedelta(minutes=10)
+    await pool.execute(
+        "INSERT INTO onboarding_code (employee_id, code, expires_at) VALUES ($1,$2,$3)",
+        employee_id, code, expires,
     )
-    return {"ok": True, "employee_id": employee_id, "code": code, "expires_at": expires.isoformat()}
+    return {"ok": True, "employee_id": employee_id, "code": code, "expires_at": expires}
 
 @app.post("/bindings/liff")
 async def bind_from_liff(p: LiffBindIn):
-    await ensure_db_ready()
-
-    # コード検証
-    row = await database.fetch_one(
-        "SELECT employee_id, expires_at, used_at FROM onboarding_code WHERE employee_id=:e AND code=:c",
-        {"e": p.employee_id, "c": p.code},
-    )
+    # コード検証 / 既存紐付け確認 / upsert / コード消費 を 1 クエリ（1 往復）で実行。
+    # 検証を通った場合（ok に行がある場合）のみ INSERT/UPDATE が効き、判定結果を 1 行で返す
+    row = await pool.fetchrow("""
+      WITH v AS (
+        SELECT used_at IS NOT NULL AS used, expires_at < NOW() AS expired
+        FROM onboarding_code WHERE employee_id=$1::bigint AND code=$2::text
+      ), c AS (
+        SELECT employee_id FROM line_binding WHERE line_user_id=$3::text
+      ), ok AS (
+        SELECT 1 FROM v
+        WHERE NOT v.used AND NOT v.expired
+          AND NOT EXISTS (SELECT 1 FROM c WHERE c.employee_id <> $1)
+      ), ins AS (
+        INSERT INTO line_binding (employee_id, line_user_id, display_name, active, verified_at)
+        SELECT $1, $3, $4::text, TRUE, NOW() FROM ok
+        ON CONFLICT (employee_id) DO UPDATE
+           SET line_user_id=EXCLUDED.line_user_id, display_name=EXCLUDED.display_name,
+               active=TRUE, verified_at=NOW(), updated_at=NOW()
+      ), up AS (
+        UPDATE onboarding_code SET used_at=NOW()
+        WHERE employee_id=$1 AND code=$2 AND EXISTS (SELECT 1 FROM ok)
+      )
+      SELECT v.used, v.expired, (SELECT employee_id FROM c) AS existing_owner
+      FROM v
+    """, p.employee_id, p.code, p.line_user_id, p.display_name)
     if not row:
         raise HTTPException(403, "invalid code")
-    if row["used_at"] is not None:
+    if row["used"]:
         raise HTTPException(403, "code already used")
-    if row["expires_at"] < dt.datetime.utcnow():
+    if row["expired"]:
         raise HTTPException(403, "code expired")
-
     # 既存の別社員への紐付けをブロック
-    own = await database.fetch_one(
-        "SELECT employee_id FROM line_binding WHERE line_user_id=:u",
-        {"u": p.line_user_id},
-    )
-    if own and own["employee_id"] != p.employee_id:
+    if row["existing_owner"] is not None and row["existing_owner"] != p.employee_id:
         raise HTTPException(409, "line_user_id already linked to another employee")
-
-    # upsert
-    await database.execute("""
-      INSERT INTO line_binding (employee_id, line_user_id, display_name, active, verified_at)
-      VALUES (:e,:u,:d, TRUE, NOW())
-      ON CONFLICT (employee_id) DO UPDATE
-         SET line_user_id=:u, display_name=:d, active=TRUE, verified_at=NOW(), updated_at=NOW()
-    """, {"e": p.employee_id, "u": p.line_user_id, "d": p.display_name})
-
-    # コード消費
-    await database.execute(
-        "UPDATE onboarding_code SET used_at=NOW() WHERE employee_id=:e AND code=:c",
-        {"e": p.employee_id, "c": p.code},
-    )
     return {"ok": True}
 
-@app.get("/bindings")
+@app.get("/bindings", response_model=None)
 async def list_bindings(active: Optional[bool] = None):
-    await ensure_db_ready()
-
     where = ""
-    params = {}
+    params = []
     if active is not None:
-        where = "WHERE active = :active"
-        params["active"] = active
-    rows = await database.fetch_all(f"""
+        where = "WHERE active = $1"
+        params.append(active)
+    rows = await pool.fetch(f"""
       SELECT employee_id, line_user_id, display_name, active, verified_at, updated_at
       FROM line_binding
       {where}
       ORDER BY employee_id
-    """, params)
-    return [dict(r) for r in rows]
+    """, *params)
+    return ORJSONResponse([dict(r) for r in rows])
 
 # ヘルスチェック（DB 非依存）
 @app.get("/healthz")
@@ -347,71 +570,106 @@ CLIENT_SECRET = os.getenv("FREEE_CLIENT_SECRET")
 INTERNAL_SECRET = os.getenv("INTERNAL_API_KEY")
 SKEW = dt.timedelta(seconds=60)
 
-async def _get_freee_row():
-    return await database.fetch_one("SELECT * FROM oauth_token WHERE provider='freee'")
+# プロセス内のトークンキャッシュ (access_token, expires_at, trusted_until) と、リフレッシュの single-flight 用ロック。
+# seed による入れ替えは他ワーカーのキャッシュには届かないため、キャッシュは expires_at までではなく
+# 最長 TOKEN_CACHE_TTL だけ信用する（他ワーカーが古いトークンを返し続けるのはこの時間まで）
+TOKEN_CACHE_TTL = dt.timedelta(seconds=60)
+_cached_token: tuple[str, dt.datetime, dt.datetime] | None = None
+_refresh_lock = asyncio.Lock()
+
+def _cache_token(at: str, exp: dt.datetime, now: dt.datetime):
+    global _cached_token
+    _cached_token = (at, exp, now + TOKEN_CACHE_TTL)
 
-async def _save_freee_row(at, rt, exp, typ=None, scope=None):
-    await database.execute("""
+def _cached_fresh_token(now: dt.datetime) -> tuple[str, dt.datetime] | None:
+    """キャッシュが信用期間内かつ期限に余裕があれば (access_token, expires_at) を返します。"""
+    if _cached_token and _cached_token[2] > now and _cached_token[1] > now + SKEW:
+        return _cached_token[0], _cached_token[1]
+    return None
+
+async def _get_freee_row(con=None):
+    return await (con or pool).fetchrow("SELECT * FROM oauth_token WHERE provider='freee'")
+
+async def _save_freee_row(at, rt, exp, typ=None, scope=None, con=None):
+    await (con or pool).execute("""
       INSERT INTO oauth_token(provider,access_token,refresh_token,expires_at,token_type,scope,updated_at)
-      VALUES('freee', :at, :rt, :exp, :typ, :scope, NOW())
+      VALUES('freee', $1, $2, $3, $4, $5, NOW())
       ON CONFLICT (provider) DO UPDATE
-      SET access_token=:at, refresh_token=:rt, expires_at=:exp, token_type=:typ, scope=:scope, updated_at=NOW()
-    """, {"at": at, "rt": rt, "exp": exp, "typ": typ, "scope": scope})
+      SET access_token=$1, refresh_token=$2, expires_at=$3, token_type=$4, scope=$5, updated_at=NOW()
+    """, at, rt, exp, typ, scope)
 
 async def _refresh_with_freee(rt: str):
-    async with httpx.AsyncClient(timeout=15) as cli:
-        resp = await cli.post(
-            FREEE_TOKEN_URL,
-            headers={"Content-Type": "application/x-www-form-urlencoded"},
-            data={
-                "grant_type": "refresh_token",
-                "refresh_token": rt,
-                "client_id": CLIENT_ID,
-                "client_secret": CLIENT_SECRET,
-            },
-        )
+    resp = await app.state.http.post(
+        FREEE_TOKEN_URL,
+        headers={"Content-Type": "application/x-www-form-urlencoded"},
+        data={
+            "grant_type": "refresh_token",
+            "refresh_token": rt,
+            "client_id": CLIENT_ID,
+            "client_secret": CLIENT_SECRET,
+        },
+    )
     if resp.status_code != 200:
         raise HTTPException(502, f"freee token refresh failed: {resp.text}")
     j = resp.json()
-    exp = dt.datetime.utcnow() + dt.timedelta(seconds=j.get("expires_in", 21600)) - SKEW
+    exp = dt.datetime.now(timezone.utc) + dt.timedelta(seconds=j.get("expires_in", 21600)) - SKEW
     # freee は refresh_token がローテーションすることがある → あれば必ず保存
     return j["access_token"], j.get("refresh_token", rt), exp, j.get("token_type"), j.get("scope")
 
 @app.get("/oauth/freee/access_token")
 async def issue_access_token(x_internal_secret: str = Header(None)):
-    await ensure_db_ready()
     if x_internal_secret != INTERNAL_SECRET:
         raise HTTPException(403, "forbidden")
 
+    # プロセス内キャッシュが有効なら DB を読まずに返す（トークンは約 6 時間ごとにしか変わらない）
+    now = dt.datetime.now(timezone.utc)
+    if cached := _cached_fresh_token(now):
+        at, exp = cached
+        return {"access_token": at, "expires_at": exp}
+
     row = await _get_freee_row()
     if not row:
         raise HTTPException(404, "seed required")
 
-    now = dt.datetime.utcnow()
     if row["expires_at"] and row["expires_at"] > now + SKEW:
-        return {"access_token": row["access_token"], "expires_at": row["expires_at"].isoformat()}
-
-    # 期限切れ/間近 → リフレッシュ（簡易二重実行対策で再読込）
-    async with database.transaction():
-        row = await _get_freee_row()
-        if row["expires_at"] and row["expires_at"] > dt.datetime.utcnow() + SKEW:
-            return {"access_token": row["access_token"], "expires_at": row["expires_at"].isoformat()}
-        at, rt, exp, typ, scope = await _refresh_with_freee(row["refresh_token"])
-        await _save_freee_row(at, rt, exp, typ, scope)
-        return {"access_token": at, "expires_at": exp.isoformat()}
+        _cache_token(row["access_token"], row["expires_at"], now)
+        return {"access_token": row["access_token"], "expires_at": row["expires_at"]}
+
+    # 期限切れ/間近 → リフレッシュ。同一プロセス内の同時リクエストはロックで 1 本にまとめ、
+    # 待っている間に先行リクエストがリフレッシュ済みなら DB に触れずその結果を返す
+    async with _refresh_lock:
+        if cached := _cached_fresh_token(now):
+            at, exp = cached
+            return {"access_token": at, "expires_at": exp}
+
+        # 他プロセスとの簡易二重実行対策で再読込
+        async with pool.acquire() as con, con.transaction():
+            row = await _get_freee_row(con)
+            if row["expires_at"] and row["expires_at"] > now + SKEW:
+                _cache_token(row["access_token"], row["expires_at"], now)
+                return {"access_token": row["access_token"], "expires_at": row["expires_at"]}
+            at, rt, exp, typ, scope = await _refresh_with_freee(row["refresh_token"])
+            await _save_freee_row(at, rt, exp, typ, scope, con=con)
+            _cache_token(at, exp, now)
+            return {"access_token": at, "expires_at": exp}
 
 # 初期投入（最初の1回だけ）※終わったら無効化してもOK
 @app.post("/oauth/freee/seed")
 async def seed_token(payload: dict, x_internal_secret: str = Header(None)):
-    await ensure_db_ready()
+    global _cached_token
     if x_internal_secret != INTERNAL_SECRET:
         raise HTTPException(403, "forbidden")
     at = payload["access_token"]
     rt = payload["refresh_token"]
-    exp = payload.get("expires_at")  # ISO でも秒でも可
+    exp = payload.get("expires_at")  # ISO でも秒でも可（タイムゾーン無しの ISO は UTC とみなす）
     if isinstance(exp, (int, float)):
-        exp = (dt.datetime.utcnow() + dt.timedelta(seconds=exp)).isoformat()
-    await _save_freee_row(at, rt, dt.datetime.fromisoformat(exp.replace("Z","")))
+        exp = dt.datetime.now(timezone.utc) + dt.timedelta(seconds=exp)
+    else:
+        exp = dt.datetime.fromisoformat(exp)
+        if exp.tzinfo is None:
+            exp = exp.replace(tzinfo=timezone.utc)
+    await _save_freee_row(at, rt, exp)
+    _cached_token = None  # このワーカーは次回 DB から読み直す（他ワーカーは TOKEN_CACHE_TTL 以内に追従）
     return {"ok": True}
 
 
@@ -430,11 +688,12 @@ async def _send_sms(to: str, text: str):
     if not (sid and token and from_):
         raise HTTPException(400, "SMS provider not configured")
 
-    async with httpx.AsyncClient(auth=(sid, token), timeout=10) as cli:
-        r = await cli.post(
-            f"https://api.twilio.com/2010-04-01/Accounts/{sid}/Messages.json",
-            data={"From": from_, "To": to, "Body": text},
-        )
+    r = await app.state.http.post(
+        f"https://api.twilio.com/2010-04-01/Accounts/{sid}/Messages.json",
+        data={"From": from_, "To": to, "Body": text},
+        auth=(sid, token),
+        timeout=10,
+    )
     # Twilioは正常時 201/200 + JSON（sid等）を返します
     try:
         body = r.json()
@@ -460,12 +719,12 @@ async def _send_email(to: str, subject: str, text: str):
       "subject": subject,
       "content":[{"type":"text/plain","value": text}],
     }
-    async with httpx.AsyncClient(timeout=10) as cli:
-        r = await cli.post(
-            "https://api.sendgrid.com/v3/mail/send",
-            headers={"Authorization": f"Bearer {sg}", "Content-Type":"application/json"},
-            json=payload,
-        )
+    r = await app.state.http.post(
+        "https://api.sendgrid.com/v3/mail/send",
+        headers={"Authorization": f"Bearer {sg}", "Content-Type":"application/json"},
+        json=payload,
+        timeout=10,
+    )
 
     # SendGrid 正常時は 202、本文なし。Message-Id がヘッダに入ることが多いです
     msg_id = r.headers.get("X-Message-Id") or r.headers.get("X-Message-Id".lower())
@@ -477,7 +736,6 @@ async def _send_email(to: str, subject: str, text: str):
 
 @app.post("/onboarding/request_code")
 async def request_code(p: RequestCodeIn, x_internal_secret: str = Header(None)):
-    await ensure_db_ready()
     if x_internal_secret != os.getenv("INTERNAL_API_KEY"):
         raise HTTPException(403, "forbidden")
 
@@ -489,18 +747,18 @@ async def request_code(p: RequestCodeIn, x_internal_secret: str = Header(None)):
     if ch == "sms" and not is_phone: raise HTTPException(400, "invalid phone")
 
     # レート制限（同一社員に60秒以内の再発行を抑制）
-    recent = await database.fetch_one(
-        "SELECT expires_at FROM onboarding_code WHERE employee_id=:e ORDER BY expires_at DESC LIMIT 1",
-        {"e": p.employee_id}
+    recent = await pool.fetchrow(
+        "SELECT expires_at FROM onboarding_code WHERE employee_id=$1 ORDER BY expires_at DESC LIMIT 1",
+        p.employee_id
     )
     # （必要なら別テーブルで created_at を持たせ、厳密に制御）
 
     # コード発行
     code = f"{secrets.randbelow(1_000_000):06d}"
-    expires = dt.datetime.utcnow() + dt.timedelta(minutes=10)
-    await database.execute(
-        "INSERT INTO onboarding_code (employee_id, code, expires_at) VALUES (:e,:c,:x)",
-        {"e": p.employee_id, "c": code, "x": expires},
+    expires = dt.datetime.now(timezone.utc) + dt.timedelta(minutes=10)
+    await pool.execute(
+        "INSERT INTO onboarding_code (employee_id, code, expires_at) VALUES ($1,$2,$3)",
+        p.employee_id, code, expires,
     )
 
     # 送信
@@ -526,6 +784,6 @@ async def request_code(p: RequestCodeIn, x_internal_secret: str = Header(None)):
         "employee_id": p.employee_id,
         "channel": ch,
         "sent_to": masked,                # マスク済宛先
-        "expires_at": expires.isoformat(),
+        "expires_at": expires,
         **info                               # ★ ここで SID / Message-Id を返す
     }
\ No newline at end of file